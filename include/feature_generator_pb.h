@@ -37,12 +37,16 @@ class FeatureGenerator {
   std::vector<int> map_idx_;
 
   float logCount(int count);
+  int generateFeature(const pybind11::array_t<float>& points, const bool use_constant_feature,
+                      const bool use_intensity_feature, std::vector<float>* in_feature);
 
  public:
   FeatureGenerator(int range, int width, int height);
   ~FeatureGenerator() {}
-  std::vector<float> generate(const pybind11::array_t<float> points, const bool use_constant_feature,
-                              const bool use_intensity_feature);
+  pybind11::array_t<float> generate(const pybind11::array_t<float> points, const bool use_constant_feature,
+                                    const bool use_intensity_feature);
+  pybind11::array generate_hwc_fp16(const pybind11::array_t<float> points, const bool use_constant_feature,
+                                    const bool use_intensity_feature);
 };
 
 #endif  // FEATURE_GENERATOR_H
@@ -2,14 +2,14 @@
 # coding: utf-8
 
 import argparse
-import copy
 import math
+import multiprocessing
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import numba
 import numpy as np
-from pyquaternion import Quaternion
 
 # import feature_generator as fg
 import feature_generator_pb as fgpb
@@ -29,6 +29,23 @@ except ImportError:
             break
 
 
+# Labels for classify_pt, keyed by the first two levels of the category name.
+# Every human.* category is mapped to 'human'.
+LABEL_MAP = {
+    'vehicle.car': 1,
+    'vehicle.bus': 2,
+    'vehicle.truck': 2,
+    'vehicle.construction': 2,
+    'vehicle.emergency': 2,
+    'vehicle.trailer': 2,
+    'vehicle.bicycle': 3,
+    'vehicle.motorcycle': 3,
+    'human': 4,
+    # 'movable_object': 1,
+    # 'static_object': 1,
+}
+
+
 def add_noise_points(points, num_rand_samples=5,
                      min_distance=5, sigma=2, add_noise_rate=0.1):
     """Add noise to the point cloud
@@ -56,34 +73,251 @@ def add_noise_points(points, num_rand_samples=5,
     min_height = np.min(points[:, 2])
     mean_height = np.mean(points[:, 2])
 
-    distances = np.linalg.norm(
-        np.hstack([points[:, 0:1], points[:, 1:2]]), axis=1)
-    max_distance = np.max(distances)
+    max_distance = np.max(np.hypot(points[:, 0], points[:, 1]))
+
+    thetas = np.deg2rad(
+        np.nonzero(np.random.rand(360) <= add_noise_rate)[0])
+    num_noise = len(thetas)
+    if num_noise == 0:
+        return points
+
+    noise_distances = np.min(np.random.uniform(
+        min_distance, max_distance, (num_noise, num_rand_samples)), axis=1)
+
+    # Rejection sampling of z within [min_height, max_height].
+    z = np.empty(0)
+    while len(z) < num_noise:
+        z_cand = np.random.normal(mean_height, sigma, num_noise * 2)
+        z_cand = z_cand[(min_height <= z_cand) & (z_cand <= max_height)]
+        z = np.concatenate([z, z_cand])
+    z = z[:num_noise]
+
+    x = noise_distances * np.cos(thetas)
+    y = noise_distances * np.sin(thetas)
+    i = points[np.random.randint(0, points.shape[0], num_noise), 3]
+    noise_points = np.column_stack([x, y, z, i])
 
-    noise_points = []
-    for theta in range(360):
-        if np.random.rand() > add_noise_rate:
-            continue
-        distance = np.min(np.random.uniform(
-            min_distance, max_distance, num_rand_samples))
-        z = np.random.normal(mean_height, sigma)
-        while min_height > z or z > max_height:
-            z = np.random.normal(mean_height, sigma)
-        x = distance * np.cos(theta)
-        y = distance * np.sin(theta)
-        i = points[np.random.randint(0, points.shape[0]), 3]
-        noise_points.append([x, y, z, i])
-
-    noise_points = np.array(noise_points)
     points = np.vstack([points, noise_points])
 
     return points
 
 
+# State of a dataset creation worker, set by init_worker.
+_worker = {}
+
+
+def init_worker(dataroot, save_dir, size, grid_range, nusc_version,
+                use_constant_feature, use_intensity_feature,
+                add_noise, nusc=None):
+    """Set up the per-process state used by process_sample.
+
+    Parameters
+    ----------
+    dataroot : str
+        Nuscenes dataroot path.
+    save_dir : str
+        Dataset save directory.
+    size : int
+        feature map size
+    grid_range : float
+        feature map range
+    nusc_version : str
+        Nuscenes version. v1.0-mini or v1.0-trainval
+    use_constant_feature : bool
+        Whether to use constant feature
+    use_intensity_feature : bool
+        Whether to use intensity feature
+    add_noise : bool
+        Whether to add noise to pointcloud
+    nusc : nuscenes.nuscenes.NuScenes, optional
+        Already loaded Nuscenes. If None, the one inherited from a forked
+        parent is used, or it is loaded, by default None
+
+    """
+    if nusc is None:
+        # Pool worker. Forked workers inherit the random state of the
+        # parent, so reseed to avoid repeating the same augmentations.
+        np.random.seed()
+        # Set by the parent before forking.
+        nusc = _worker.get('nusc')
+    if nusc is None:
+        nusc = NuScenes(
+            version=nusc_version,
+            dataroot=dataroot, verbose=False)
+
+    if use_constant_feature and use_intensity_feature:
+        channels = 8
+    elif use_constant_feature or use_intensity_feature:
+        channels = 6
+    else:
+        channels = 4
+
+    grid_length = 2. * grid_range / size
+
+    _worker.update(
+        nusc=nusc,
+        save_dir=save_dir,
+        size=size,
+        grid_range=grid_range,
+        channels=channels,
+        use_constant_feature=use_constant_feature,
+        use_intensity_feature=use_intensity_feature,
+        add_noise=add_noise,
+        # Lidar coordinate of each feature map pixel center,
+        # same as Pixel2pc with out_range=grid_range.
+        grid_centers=grid_range - (np.arange(size) + 0.5) * grid_length,
+        # feature_generator = fg.FeatureGenerator(
+        #     grid_range, width, height,
+        #     use_constant_feature, use_intensity_feature)
+        feature_generator=fgpb.FeatureGenerator(grid_range, size, size),
+        # Channel-first while rasterizing the boxes,
+        # saved as (size, size, 8).
+        out_feature=np.zeros((8, size, size), dtype=np.float32))
+
+
+def process_sample(task):
+    """Create the data of one sample and its augmentations.
+
+    Parameters
+    ----------
+    task : tuple
+        (token, sample_id, data_id, num_data). Sample token, sample index,
+        id of the first data to save and how many data to save
+        for this sample, including the sample itself.
+
+    """
+    token, sample_id, data_id, num_data = task
+    augmentation_num = num_data - 1
+    nusc = _worker['nusc']
+    save_dir = _worker['save_dir']
+    size = _worker['size']
+    grid_range = _worker['grid_range']
+    channels = _worker['channels']
+    use_constant_feature = _worker['use_constant_feature']
+    use_intensity_feature = _worker['use_intensity_feature']
+    add_noise = _worker['add_noise']
+    grid_centers = _worker['grid_centers']
+    feature_generator = _worker['feature_generator']
+    out_feature = _worker['out_feature']
+
+    ref_chan = 'LIDAR_TOP'
+    z_trans_range = 0.5
+
+    print('sample:{} {} created_data={}'.format(
+        sample_id, token, data_id))
+    my_sample = nusc.get('sample', token)
+    sd_record = nusc.get(
+        'sample_data', my_sample['data'][ref_chan])
+    sample_rec = nusc.get('sample', sd_record['sample_token'])
+    chan = sd_record['channel']
+    pc_raw, _ = LidarPointCloud.from_file_multisweep(
+        nusc, sample_rec, chan, ref_chan, nsweeps=1)
+
+    _, boxes_raw, _ = nusc.get_sample_data(
+        sd_record['token'], box_vis_level=0)
+
+    # Z translation and z-axis rotation of each augmentation.
+    # Index 0 is the sample itself.
+    z_trans = np.zeros(augmentation_num + 1)
+    z_rads = np.zeros(augmentation_num + 1)
+    z_trans[1:] = (np.random.rand(augmentation_num) - 0.5) \
+        * 2 * z_trans_range
+    z_rads[1:] = np.random.rand(augmentation_num) * np.pi * 2
+    rotation_matrices = np.zeros((augmentation_num, 3, 3))
+    rotation_matrices[:, 0, 0] = np.cos(z_rads[1:])
+    rotation_matrices[:, 0, 1] = -np.sin(z_rads[1:])
+    rotation_matrices[:, 1, 0] = np.sin(z_rads[1:])
+    rotation_matrices[:, 1, 1] = np.cos(z_rads[1:])
+    rotation_matrices[:, 2, 2] = 1.
+
+    # Every augmentation is written to its own slice, so pc_raw is never
+    # modified and the sample itself needs no transform.
+    pcs = np.empty(
+        (augmentation_num + 1, ) + pc_raw.points.shape,
+        dtype=np.float32)
+    pcs[0] = pc_raw.points
+    pcs[1:, :3] = np.einsum(
+        'aij,jn->ain', rotation_matrices, pc_raw.points[:3])
+    pcs[1:, 2] += z_trans[1:, None]
+    pcs[1:, 3:] = pc_raw.points[3:]
+
+    labels = []
+    heights = []
+    yaws = []
+    box_corners_raw = []
+    for box in boxes_raw:
+        name = box.name.split('.')
+        if name[0] == 'human':
+            label = LABEL_MAP['human']
+        else:
+            label = LABEL_MAP.get('.'.join(name[:2]))
+        if label is None:
+            continue
+        corners = box.corners()
+        labels.append(label)
+        heights.append(np.linalg.norm(corners[:, 0] - corners[:, 3]))
+        yaw, pitch, roll = box.orientation.yaw_pitch_roll
+        yaws.append(yaw)
+        box_corners_raw.append(corners)
+    box_corners_raw = np.array(box_corners_raw).reshape(-1, 3, 8)
+
+    # Rotating around z adds z_rad to the yaw and keeps the height.
+    boxes_corners = np.empty(
+        (augmentation_num + 1, ) + box_corners_raw.shape,
+        dtype=np.float32)
+    boxes_corners[0] = box_corners_raw
+    boxes_corners[1:] = np.einsum(
+        'aij,bjk->abik', rotation_matrices, box_corners_raw)
+    boxes_corners[1:, :, 2] += z_trans[1:, None, None]
+
+    for augmentation_idx in range(augmentation_num + 1):
+        pc_points = pcs[augmentation_idx]
+        if add_noise:
+            pc_points = add_noise_points(
+                pc_points.T).T.astype(np.float32)
+        pc_x = np.ascontiguousarray(pc_points[0])
+        pc_y = np.ascontiguousarray(pc_points[1])
+        pc_z = np.ascontiguousarray(pc_points[2])
+
+        out_feature.fill(0.)
+        for box_idx, label in enumerate(labels):
+            box_corners = boxes_corners[augmentation_idx, box_idx]
+            corners2d = box_corners[:2, :]
+            box2d = corners2d.T[[2, 3, 7, 6]]
+            box2d_center = box2d.mean(axis=0)
+            yaw = yaws[box_idx] + z_rads[augmentation_idx]
+            out_feature = generate_out_feature(
+                size, grid_range, grid_centers, box_corners,
+                box2d, box2d_center, pc_x, pc_y, pc_z,
+                heights[box_idx], label, yaw, out_feature)
+
+        if hasattr(feature_generator, 'generate_hwc_fp16'):
+            in_feature = feature_generator.generate_hwc_fp16(
+                pc_points.T,
+                use_constant_feature, use_intensity_feature)
+        else:
+            # feature_generator_pb built before generate_hwc_fp16 was added.
+            in_feature = feature_generator.generate(
+                pc_points.T,
+                use_constant_feature, use_intensity_feature)
+
+            in_feature = np.asarray(in_feature, dtype=np.float32).reshape(
+                channels, size, size).astype(np.float16)
+            in_feature = in_feature.transpose(1, 2, 0)
+        file_name = '{:05}'.format(data_id + augmentation_idx)
+        np.save(os.path.join(
+            save_dir, 'in_feature', file_name),
+            in_feature)
+        np.save(os.path.join(
+            save_dir, 'out_feature', file_name),
+            out_feature.transpose(1, 2, 0).astype(np.float16))
+
+
 def create_dataset(dataroot, save_dir, width=672, height=672, grid_range=70.,
                    nusc_version='v1.0-mini',
                    use_constant_feature=False, use_intensity_feature=True,
-                   end_id=None, augmentation_num=0, add_noise=False):
+                   end_id=None, augmentation_num=0, add_noise=False,
+                   num_workers=1):
     """Create a learning dataset from Nuscens
 
     Parameters
@@ -110,6 +344,8 @@ def create_dataset(dataroot, save_dir, width=672, height=672, grid_range=70.,
         How many data augmentations for one sample, by default 0
     add_noise : bool, optional
         Whether to add noise to pointcloud, by default True
+    num_workers : int, optional
+        Number of processes to create data in parallel, by default 1
 
     Raises
     ------
@@ -123,7 +359,6 @@ def create_dataset(dataroot, save_dir, width=672, height=672, grid_range=70.,
     nusc = NuScenes(
         version=nusc_version,
         dataroot=dataroot, verbose=True)
-    ref_chan = 'LIDAR_TOP'
 
     if width == height:
         size = width
@@ -131,135 +366,103 @@ def create_dataset(dataroot, save_dir, width=672, height=672, grid_range=70.,
         raise Exception(
             'Currently only supported if width and height are equal')
 
-    grid_length = 2. * grid_range / size
-    z_trans_range = 0.5
+    # Every sample is independent and saves to its own data ids,
+    # so collect them first and create the data in parallel.
+    tasks = []
     sample_id = 0
     data_id = 0
-    grid_ticks = np.arange(
-        -grid_range, grid_range + grid_length, grid_length)
-    grid_centers \
-        = (grid_ticks + grid_length / 2)[:len(grid_ticks) - 1]
-
     for my_scene in nusc.scene:
-        first_sample_token = my_scene['first_sample_token']
-        token = first_sample_token
-
-        # try:
-        while(token != ''):
-            print('sample:{} {} created_data={}'.format(
-                sample_id, token, data_id))
-            my_sample = nusc.get('sample', token)
-            sd_record = nusc.get(
-                'sample_data', my_sample['data'][ref_chan])
-            sample_rec = nusc.get('sample', sd_record['sample_token'])
-            chan = sd_record['channel']
-            pc_raw, _ = LidarPointCloud.from_file_multisweep(
-                nusc, sample_rec, chan, ref_chan, nsweeps=1)
-
-            _, boxes_raw, _ = nusc.get_sample_data(
-                sd_record['token'], box_vis_level=0)
-
-            z_trans = 0
-            q = Quaternion()
-            for augmentation_idx in range(augmentation_num + 1):
-                pc = copy.copy(pc_raw)
-                if add_noise:
-                    pc.points = add_noise_points(pc.points.T).T
-                boxes = copy.copy(boxes_raw)
-                if augmentation_idx > 0:
-                    z_trans = (np.random.rand() - 0.5) * 2 * z_trans_range
-                    pc.translate([0, 0, z_trans])
-
-                    z_rad = np.random.rand() * np.pi * 2
-                    q = Quaternion(axis=[0, 0, 1], radians=z_rad)
-                    pc.rotate(q.rotation_matrix)
-
-                pc_points = pc.points.astype(np.float32)
-
-                out_feature = np.zeros((size, size, 8), dtype=np.float32)
-                for box_idx, box in enumerate(boxes):
-                    if augmentation_idx > 0:
-                        box.translate([0, 0, z_trans])
-                        box.rotate(q)
-
-                    label = 0
-                    if box.name.split('.')[0] == 'vehicle':
-                        if box.name.split('.')[1] == 'car':
-                            label = 1
-                        elif box.name.split('.')[1] == 'bus':
-                            label = 2
-                        elif box.name.split('.')[1] == 'truck':
-                            label = 2
-                        elif box.name.split('.')[1] == 'construction':
-                            label = 2
-                        elif box.name.split('.')[1] == 'emergency':
-                            label = 2
-                        elif box.name.split('.')[1] == 'trailer':
-                            label = 2
-                        elif box.name.split('.')[1] == 'bicycle':
-                            label = 3
-                        elif box.name.split('.')[1] == 'motorcycle':
-                            label = 3
-                    elif box.name.split('.')[0] == 'human':
-                        label = 4
-                    # elif box.name.split('.')[0] == 'movable_object':
-                    #     label = 1
-                    # elif box.name.split('.')[0] == 'static_object':
-                    #     label = 1
-                    else:
-                        continue
-                    height_pt = np.linalg.norm(
-                        box.corners().T[0] - box.corners().T[3])
-                    box_corners = box.corners().astype(np.float32)
-                    corners2d = box_corners[:2, :]
-                    box2d = corners2d.T[[2, 3, 7, 6]]
-                    box2d_center = box2d.mean(axis=0)
-                    yaw, pitch, roll = box.orientation.yaw_pitch_roll
-                    out_feature = generate_out_feature(
-                        size, grid_centers, box_corners,
-                        box2d, box2d_center, pc_points,
-                        height_pt, label, yaw, out_feature)
-
-                # feature_generator = fg.FeatureGenerator(
-                #     grid_range, width, height,
-                #     use_constant_feature, use_intensity_feature)
-                feature_generator = fgpb.FeatureGenerator(
-                    grid_range, size, size)
-                in_feature = feature_generator.generate(
-                    pc_points.T,
-                    use_constant_feature, use_intensity_feature)
-
-                if use_constant_feature and use_intensity_feature:
-                    channels = 8
-                elif use_constant_feature or use_intensity_feature:
-                    channels = 6
-                else:
-                    channels = 4
-
-                in_feature = np.array(in_feature).reshape(
-                    channels, size, size).astype(np.float16)
-                in_feature = in_feature.transpose(1, 2, 0)
-                np.save(os.path.join(
-                    save_dir, 'in_feature/{:05}'.format(data_id)),
-                    in_feature)
-                np.save(os.path.join(
-                    save_dir, 'out_feature/{:05}'.format(data_id)),
-                    out_feature)
-                token = my_sample['next']
-                data_id += 1
-                if data_id == end_id:
-                    return
+        token = my_scene['first_sample_token']
+        while(token != '' and data_id != end_id):
+            num_data = augmentation_num + 1
+            if end_id is not None:
+                num_data = min(num_data, end_id - data_id)
+            tasks.append((token, sample_id, data_id, num_data))
+            token = nusc.get('sample', token)['next']
             sample_id += 1
-        # except KeyboardInterrupt:
-        #     return
-        # except BaseException:
-        #     print('skipped')
-        #     continue
+            data_id += num_data
+
+    initargs = (dataroot, save_dir, size, grid_range, nusc_version,
+                use_constant_feature, use_intensity_feature, add_noise)
+    if num_workers > 1:
+        if multiprocessing.get_start_method() == 'fork':
+            # Forked workers share the loaded tables instead of reloading.
+            _worker['nusc'] = nusc
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 initializer=init_worker,
+                                 initargs=initargs) as executor:
+            list(executor.map(process_sample, tasks))
+    else:
+        init_worker(*initargs, nusc=nusc)
+        for task in tasks:
+            process_sample(task)
+
+
+@numba.njit(fastmath=True, cache=True)
+def count_points_in_box(corners, pc_x, pc_y, pc_z):
+    """Count the points inside the box.
 
+    Partially changed the function implemented in
+    "https://github.com/nutonomy/nuscenes-devkit/blob/master/python-sdk/nuscenes/utils/geometry_utils.py"
 
-@numba.jit(nopython=True)
-def generate_out_feature(size, grid_centers, box_corners,
-                         box2d, box2d_center, pc_points,
+    Picks one corner as reference (p1) and computes
+    the vector to a target point (v).
+    Then for each of the 3 axes, project v onto the axis
+    and compare the length.
+    Inspired by: https://math.stackexchange.com/a/1552579
+
+    Parameters
+    ----------
+    corners : numpy.ndarray
+        The coordinates of each corner of the object's box. (3, 8)
+    pc_x : numpy.ndarray
+        x coordinates of the point cloud. (n, )
+    pc_y : numpy.ndarray
+        y coordinates of the point cloud. (n, )
+    pc_z : numpy.ndarray
+        z coordinates of the point cloud. (n, )
+
+    Returns
+    -------
+    num_points : int
+        Number of points inside the box.
+
+    """
+    p1_x = corners[0, 0]
+    p1_y = corners[1, 0]
+    p1_z = corners[2, 0]
+
+    pi_x = corners[0, 4] - p1_x
+    pi_y = corners[1, 4] - p1_y
+    pi_z = corners[2, 4] - p1_z
+    pj_x = corners[0, 1] - p1_x
+    pj_y = corners[1, 1] - p1_y
+    pj_z = corners[2, 1] - p1_z
+    pk_x = corners[0, 3] - p1_x
+    pk_y = corners[1, 3] - p1_y
+    pk_z = corners[2, 3] - p1_z
+
+    pi_len2 = pi_x * pi_x + pi_y * pi_y + pi_z * pi_z
+    pj_len2 = pj_x * pj_x + pj_y * pj_y + pj_z * pj_z
+    pk_len2 = pk_x * pk_x + pk_y * pk_y + pk_z * pk_z
+
+    num_points = 0
+    for n in range(pc_x.shape[0]):
+        v_x = pc_x[n] - p1_x
+        v_y = pc_y[n] - p1_y
+        v_z = pc_z[n] - p1_z
+        iv = pi_x * v_x + pi_y * v_y + pi_z * v_z
+        jv = pj_x * v_x + pj_y * v_y + pj_z * v_z
+        kv = pk_x * v_x + pk_y * v_y + pk_z * v_z
+        if 0 <= iv <= pi_len2 and 0 <= jv <= pj_len2 \
+           and 0 <= kv <= pk_len2:
+            num_points += 1
+
+    return num_points
+
+
+def generate_out_feature(size, grid_range, grid_centers, box_corners,
+                         box2d, box2d_center, pc_x, pc_y, pc_z,
                          height_pt, label, yaw, out_feature):
     """Generate out_feature.
 
@@ -267,16 +470,23 @@ def generate_out_feature(size, grid_centers, box_corners,
     ----------
     size : int
         feature map size
+    grid_range : float
+        feature map range
     grid_centers : numpy.ndarray
-        center coordinates of feature_map grid
+        center coordinates of feature_map grid in lidar coordinate system,
+        indexed by pixel. (size, )
     box_corners : numpy.ndarray
         The coordinates of each corner of the object's box.
     box2d : numpy.ndarray
         The x,y coordinates of the object's box
     box2d_center : numpy.ndarray
         Center x,y coordinates of object's box
-    pc_points : numpy.ndarray
-        Input point cloud. (4, n)
+    pc_x : numpy.ndarray
+        x coordinates of the input point cloud. (n, )
+    pc_y : numpy.ndarray
+        y coordinates of the input point cloud. (n, )
+    pc_z : numpy.ndarray
+        z coordinates of the input point cloud. (n, )
     height_pt : float
         Height of object.
     label : int
@@ -285,13 +495,13 @@ def generate_out_feature(size, grid_centers, box_corners,
         Rotation of the yaw of the object. heading_pt.
     out_feature : numpy.ndarray
         Output features. category, instance(x, y),
-        confidence, classify, heading(x, y), height
+        confidence, classify, heading(x, y), height. (8, size, size)
 
     Returns
     -------
     out_feature : numpy.ndarray
         Output features. category, instance(x, y),
-        confidence, classify, heading(x, y), height
+        confidence, classify, heading(x, y), height. (8, size, size)
 
     """
     box2d_left = box2d[:, 0].min()
@@ -299,133 +509,71 @@ def generate_out_feature(size, grid_centers, box_corners,
     box2d_top = box2d[:, 1].max()
     box2d_bottom = box2d[:, 1].min()
 
-    def points_in_box(corners, points, wlh_factor=1.0):
-        """Check whether points are inside the box.
-
-        Partially changed the function implemented in
-        "https://github.com/nutonomy/nuscenes-devkit/blob/master/python-sdk/nuscenes/utils/geometry_utils.py"
-
-        Picks one corner as reference (p1) and computes
-        the vector to a target point (v).
-        Then for each of the 3 axes, project v onto the axis
-        and compare the length.
-        Inspired by: https://math.stackexchange.com/a/1552579
-
-        :param box: <Box>.
-        :param points: <np.float: 3, n>.
-        :param wlh_factor: Inflates or deflates the box.
-        :return: <np.bool: n, >.
-
-        """
-        p1 = corners[:, 0]
-        p_x = corners[:, 4]
-        p_y = corners[:, 1]
-        p_z = corners[:, 3]
-
-        pi = p_x - p1
-        pj = p_y - p1
-        pk = p_z - p1
-
-        v = points - np.array([[p1[0]], [p1[1]], [p1[2]]]).astype(np.float32)
-
-        iv = np.dot(pi, v)
-        jv = np.dot(pj, v)
-        kv = np.dot(pk, v)
-
-        mask_x = np.logical_and(0 <= iv, iv <= np.dot(pi, pi))
-        mask_y = np.logical_and(0 <= jv, jv <= np.dot(pj, pj))
-        mask_z = np.logical_and(0 <= kv, kv <= np.dot(pk, pk))
-        mask = np.logical_and(np.logical_and(mask_x, mask_y), mask_z)
-
-        return mask
-
-    def points_in_box2d(corners, box2d, points):
-        """2D version of points_in_box"""
-        p1 = box2d[0]
-        p_x = box2d[1]
-        p_y = box2d[3]
-
-        pi = p_x - p1
-        pj = p_y - p1
-
-        v = points[:2] - p1
-
-        iv = np.dot(pi, v)
-        jv = np.dot(pj, v)
-
-        mask_x = np.logical_and(0 <= iv, iv <= np.dot(pi, pi))
-        mask_y = np.logical_and(0 <= jv, jv <= np.dot(pj, pj))
-        mask = np.logical_and(mask_x, mask_y)
-
-        return mask
-
     def F2I(val, orig, scale):
         """Convert points in lidar coordinate system to feature_map coordinate system."""
-        return int(np.floor((orig - val) * scale))
-
-    def Pixel2pc(in_pixel, in_size, out_range):
-        """Convert points in feature_map coordinate system to lidar coordinate system."""
-
-        res = 2.0 * out_range / in_size
-        return out_range - (in_pixel + 0.5) * res
+        return int(math.floor((orig - val) * scale))
 
-    inv_res = 0.5 * size / 70.
+    inv_res = 0.5 * size / grid_range
     res = 1.0 / inv_res
     max_length = abs(2 * res)
 
-    search_area_left_idx = F2I(box2d_left, 70, inv_res)
-    search_area_right_idx = F2I(box2d_right, 70, inv_res)
-    search_area_top_idx = F2I(box2d_top, 70, inv_res)
-    search_area_bottom_idx = F2I(box2d_bottom, 70, inv_res)
-
-    num_points = np.count_nonzero(points_in_box(box_corners, pc_points[:3, :]))
-    if num_points < 4 and label == 0:
-        return out_feature
-    elif num_points < 4 and label == 1:
+    search_area_left_idx = F2I(box2d_left, grid_range, inv_res)
+    search_area_right_idx = F2I(box2d_right, grid_range, inv_res)
+    search_area_top_idx = F2I(box2d_top, grid_range, inv_res)
+    search_area_bottom_idx = F2I(box2d_bottom, grid_range, inv_res)
+
+    # Clamp the search area to the feature map once.
+    i_start = max(search_area_right_idx - 1, 0)
+    i_end = min(search_area_left_idx + 1, size)
+    j_start = max(search_area_top_idx - 1, 0)
+    j_end = min(search_area_bottom_idx + 1, size)
+    if i_start >= i_end or j_start >= j_end:
         return out_feature
-    elif num_points < 4 and label == 2:
-        return out_feature
-    elif num_points < 4 and label == 3:
-        return out_feature
-    elif num_points < 4 and label == 4:
+
+    num_points = count_points_in_box(box_corners, pc_x, pc_y, pc_z)
+    if num_points < 4:
         return out_feature
 
-    for i in range(
-            search_area_right_idx - 1, search_area_left_idx + 1):
-        for j in range(
-                search_area_top_idx - 1, search_area_bottom_idx + 1):
-            if 0 <= i and i < size and 0 <= j and j < size:
-                grid_center_x = Pixel2pc(i, float(size), 70)
-                grid_center_y = Pixel2pc(j, float(size), 70)
-
-                if max_length < np.abs(box2d_center[0] - grid_center_x):
-                    x_scale = max_length / \
-                        np.abs(box2d_center[0] - grid_center_x)
-                else:
-                    x_scale = 1.
-                if max_length < np.abs(box2d_center[1] - grid_center_y):
-                    y_scale = max_length / \
-                        np.abs(box2d_center[1] - grid_center_y)
-                else:
-                    y_scale = 1.
-
-                normalized_yaw = math.atan(math.sin(yaw) / math.cos(yaw))
-
-                mask = points_in_box2d(
-                    box_corners, box2d,
-                    np.array([grid_center_x, grid_center_y, 0]).astype(np.float32))
-
-                if mask:
-                    out_feature[i, j, 0] = 1.  # category_pt
-                    out_feature[i, j, 1] = (
-                        (box2d_center[0] - grid_center_x) * -1) * min(x_scale, y_scale)
-                    out_feature[i, j, 2] = (
-                        (box2d_center[1] - grid_center_y) * -1) * min(x_scale, y_scale)
-                    out_feature[i, j, 3] = 1.  # confidence_pt
-                    out_feature[i, j, 4] = label  # classify_pt
-                    out_feature[i, j, 5] = math.cos(normalized_yaw * 2.0)
-                    out_feature[i, j, 6] = math.sin(normalized_yaw * 2.0)
-                    out_feature[i, j, 7] = height_pt  # height_pt
+    # The doubled angle makes the heading invariant to a flip of pi, so
+    # atan2 gives the same result as atan(sin / cos) without the division.
+    normalized_yaw = math.atan2(math.sin(yaw), math.cos(yaw))
+    heading_x = math.cos(normalized_yaw * 2.0)
+    heading_y = math.sin(normalized_yaw * 2.0)
+
+    # 2D version of points_in_box, evaluated for the whole search area.
+    p1_x = box2d[0, 0]
+    p1_y = box2d[0, 1]
+    pi_x = box2d[1, 0] - p1_x
+    pi_y = box2d[1, 1] - p1_y
+    pj_x = box2d[3, 0] - p1_x
+    pj_y = box2d[3, 1] - p1_y
+    pi_len2 = pi_x * pi_x + pi_y * pi_y
+    pj_len2 = pj_x * pj_x + pj_y * pj_y
+
+    grid_center_x = grid_centers[i_start:i_end, None]
+    grid_center_y = grid_centers[None, j_start:j_end]
+    v_x = grid_center_x - p1_x
+    v_y = grid_center_y - p1_y
+    iv = pi_x * v_x + pi_y * v_y
+    jv = pj_x * v_x + pj_y * v_y
+    mask = (0 <= iv) & (iv <= pi_len2) & (0 <= jv) & (jv <= pj_len2)
+
+    diff_x = box2d_center[0] - grid_center_x
+    diff_y = box2d_center[1] - grid_center_y
+    # Shrink the instance vector when it is longer than max_length.
+    x_scale = np.minimum(1., max_length / np.maximum(np.abs(diff_x), 1e-30))
+    y_scale = np.minimum(1., max_length / np.maximum(np.abs(diff_y), 1e-30))
+    scale = np.minimum(x_scale, y_scale)
+
+    search_area = out_feature[:, i_start:i_end, j_start:j_end]
+    search_area[0][mask] = 1.  # category_pt
+    search_area[1][mask] = (diff_x * -1 * scale)[mask]
+    search_area[2][mask] = (diff_y * -1 * scale)[mask]
+    search_area[3][mask] = 1.  # confidence_pt
+    search_area[4][mask] = label  # classify_pt
+    search_area[5][mask] = heading_x  # heading_pt
+    search_area[6][mask] = heading_y
+    search_area[7][mask] = height_pt  # height_pt
 
     return out_feature
 
@@ -467,6 +615,9 @@ if __name__ == '__main__':
     parser.add_argument('--add_noise', type=int,
                         help='Whether to add noise to pointcloud',
                         default=0)
+    parser.add_argument('--num_workers', '-j', type=int,
+                        help='Number of processes to create data in parallel',
+                        default=1)
 
     args = parser.parse_args()
     create_dataset(dataroot=args.dataroot,
@@ -479,4 +630,5 @@ if __name__ == '__main__':
                    use_intensity_feature=args.use_intensity_feature,
                    end_id=args.end_id,
                    augmentation_num=args.augmentation_num,
-                   add_noise=args.add_noise)
+                   add_noise=args.add_noise,
+                   num_workers=args.num_workers)
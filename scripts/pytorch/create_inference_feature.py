@@ -274,7 +274,9 @@ def create_dataset(dataroot, save_dir, pretrained_model, width=672, height=672,
             else:
                 channels = 4
 
-            in_feature = np.array(in_feature).reshape(
+            # generate returns a list on feature_generator_pb built
+            # before it returned an ndarray.
+            in_feature = np.asarray(in_feature, dtype=np.float32).reshape(
                 channels, size, size).astype(np.float16)
             in_feature = in_feature.transpose(1, 2, 0)
 
@@ -16,6 +16,10 @@
 
 #include "feature_generator_pb.h"
 
+#include <cstdint>
+#include <cstring>
+#include <memory>
+
 FeatureGenerator::FeatureGenerator(int range, int width, int height)
 
     : min_height_(-5.0), max_height_(5.0), range_(range), width_(width), height_(height) {
@@ -34,13 +38,85 @@ float FeatureGenerator::logCount(int count) {
   return std::log(static_cast<float>(1 + count));
 }
 
-std::vector<float> FeatureGenerator::generate(const pybind11::array_t<float> points, const bool use_constant_feature,
-                                              const bool use_intensity_feature) {
+// Convert to IEEE 754 half precision, rounding to nearest even.
+static uint16_t FloatToHalf(float value) {
+  uint32_t bits;
+  std::memcpy(&bits, &value, sizeof(bits));
+  const uint32_t sign = (bits >> 16) & 0x8000;
+  const uint32_t abs_bits = bits & 0x7fffffff;
+
+  if (abs_bits >= 0x7f800000) {
+    // inf or nan
+    return static_cast<uint16_t>(sign | 0x7c00 | (abs_bits > 0x7f800000 ? 0x200 : 0));
+  }
+  if (abs_bits >= 0x477ff000) {
+    // rounds to inf
+    return static_cast<uint16_t>(sign | 0x7c00);
+  }
+  if (abs_bits < 0x38800000) {
+    // subnormal or zero
+    if (abs_bits < 0x33000000) {
+      return static_cast<uint16_t>(sign);
+    }
+    const uint32_t shift = 126 - (abs_bits >> 23);
+    const uint32_t mantissa = (abs_bits & 0x7fffff) | 0x800000;
+    uint32_t half = mantissa >> shift;
+    const uint32_t rem = mantissa & ((1u << shift) - 1);
+    const uint32_t halfway = 1u << (shift - 1);
+    if (rem > halfway || (rem == halfway && (half & 1))) {
+      ++half;
+    }
+    return static_cast<uint16_t>(sign | half);
+  }
+
+  uint32_t half = (abs_bits - 0x38000000) >> 13;
+  const uint32_t rem = abs_bits & 0x1fff;
+  if (rem > 0x1000 || (rem == 0x1000 && (half & 1))) {
+    ++half;
+  }
+  return static_cast<uint16_t>(sign | half);
+}
+
+pybind11::array_t<float> FeatureGenerator::generate(const pybind11::array_t<float> points,
+                                                    const bool use_constant_feature,
+                                                    const bool use_intensity_feature) {
+  std::unique_ptr<std::vector<float>> in_feature(new std::vector<float>());
+  const int channels = generateFeature(points, use_constant_feature, use_intensity_feature, in_feature.get());
+
+  // (channels, height, width) float32 that owns the feature buffer.
+  float* data = in_feature->data();
+  pybind11::capsule owner(in_feature.release(),
+                          [](void* ptr) { delete reinterpret_cast<std::vector<float>*>(ptr); });
+  return pybind11::array_t<float>({channels, height_, width_}, data, owner);
+}
+
+pybind11::array FeatureGenerator::generate_hwc_fp16(const pybind11::array_t<float> points,
+                                                    const bool use_constant_feature,
+                                                    const bool use_intensity_feature) {
+  const int channels = generateFeature(points, use_constant_feature, use_intensity_feature, &in_feature_);
+  const int siz = height_ * width_;
+
+  // (height, width, channels) float16, the layout saved as in_feature.
+  pybind11::array hwc_feature(pybind11::dtype("e"), std::vector<size_t>{static_cast<size_t>(height_),
+                                                                         static_cast<size_t>(width_),
+                                                                         static_cast<size_t>(channels)});
+  uint16_t* hwc_data = static_cast<uint16_t*>(hwc_feature.mutable_data());
+  for (int i = 0; i < siz; ++i) {
+    for (int c = 0; c < channels; ++c) {
+      hwc_data[i * channels + c] = FloatToHalf(in_feature_[c * siz + i]);
+    }
+  }
+
+  return hwc_feature;
+}
+
+int FeatureGenerator::generateFeature(const pybind11::array_t<float>& points, const bool use_constant_feature,
+                                      const bool use_intensity_feature, std::vector<float>* in_feature_ptr) {
   const auto& buff_info = points.request();
   const auto& shape = buff_info.shape;
 
   int siz = height_ * width_;
-  std::vector<float> in_feature;
+  std::vector<float>& in_feature = *in_feature_ptr;
 
   float *max_height_data, *direction_data, *mean_height_data, *distance_data, *count_data, *top_intensity_data,
       *mean_intensity_data, *nonempty_data;
@@ -140,7 +216,7 @@ std::vector<float> FeatureGenerator::generate(const pybind11::array_t<float> poi
     count_data[i] = logCount(static_cast<int>(count_data[i]));
   }
 
-  return in_feature;
+  return channels;
 }
 
 namespace py = pybind11;
@@ -149,7 +225,8 @@ PYBIND11_PLUGIN(feature_generator_pb) {
 
   py::class_<FeatureGenerator>(m, "FeatureGenerator")
       .def(py::init<int, int, int>())
-      .def("generate", &FeatureGenerator::generate);
+      .def("generate", &FeatureGenerator::generate)
+      .def("generate_hwc_fp16", &FeatureGenerator::generate_hwc_fp16);
 
   return m.ptr();
 }